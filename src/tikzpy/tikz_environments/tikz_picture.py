@@ -1,26 +1,24 @@
 import subprocess
 import webbrowser
 import tempfile
-import re
+import hashlib
+import os
+import weakref
 
-import numpy as np
 from pathlib import Path
+from shutil import copyfile, rmtree
 from typing import List, Optional
 from tikzpy.tikz_environments.scope import Scope
 from tikzpy.tikz_environments.tikz_environment import TikzEnvironment
 from tikzpy.tikz_environments.tikz_style import TikzStyle
 from tikzpy.utils.helpers import (
     brackets,
-    true_posix_path,
     replace_code,
-    find_image_start_boundary,
-    find_image_end_boundary,
+    find_image_boundaries,
     extract_error_content,
 )
 from tikzpy.utils.types import CompileError
 from tikzpy.templates.tex_file import TEX_FILE
-from pdf2image import convert_from_path
-from PIL import Image
 
 
 class TikzPicture(TikzEnvironment):
@@ -34,15 +32,42 @@ class TikzPicture(TikzEnvironment):
     Parameters:
         center: True/False if one wants to center their Tikz code
         options: A list of options for the Tikz picture
+        use_cache: True/False if compiled PDFs should be cached in CACHE_DIR, keyed by
+                   the hash of the generated TeX file, so unchanged pictures skip latexmk.
+                   CACHE_DIR defaults to ~/.tikzpy_cache when left as None
+        externalize: True/False if TikZ's external library should be used. The picture is then
+                     compiled in a build directory that lives as long as the TikzPicture, and
+                     TikZ only re-renders the picture when its code changes
     """
 
+    # Resolved on first use, so importing tikzpy does not depend on a home directory
+    CACHE_DIR: Optional[Path] = None
+
     def __init__(
-        self, center: bool = False, options: str = "", tikz_code_dir=None
+        self,
+        center: bool = False,
+        options: str = "",
+        tikz_code_dir=None,
+        use_cache: bool = False,
+        externalize: bool = False,
     ) -> None:
         super().__init__(options)
         self._preamble = {}
         self._postamble = {}
+        # Statements placed in the preamble of the TeX document, before \begin{document}
+        self._tex_preamble = {}
         self.BASE_DIR = None
+        self.use_cache = use_cache
+        self.externalize = externalize
+        self._temp_dir = None
+        self._temp_dir_finalizer = None
+
+        if externalize:
+            # TeX refuses to write to absolute paths by default, so the prefix is
+            # relative to TEMP_DIR, which compile() runs latexmk from.
+            self._tex_preamble[
+                "external"
+            ] = "\\usetikzlibrary{external}\n\\tikzexternalize[prefix=ext/]\n"
 
         if tikz_code_dir is not None:
             self.BASE_DIR = Path(tikz_code_dir)
@@ -56,30 +81,23 @@ class TikzPicture(TikzEnvironment):
 
     def code(self) -> str:
         """Returns a string contaning the generated Tikz code."""
-        code = ""
         # Add the beginning statement
-        for stmt in self._preamble.values():
-            code += stmt
-        code += f"\\begin{{tikzpicture}}{brackets(self.options)}\n"
+        parts = list(self._preamble.values())
+        parts.append(f"\\begin{{tikzpicture}}{brackets(self.options)}\n")
 
         # Add the main tikz code
-        for draw_obj in self.drawing_objects:
-            code += "    " + draw_obj.code + "\n"
+        parts.extend(f"    {draw_obj.code}\n" for draw_obj in self.drawing_objects)
 
         # Add the ending statement
-        code += "\\end{tikzpicture}\n"
-        for stmt in list(reversed(list(self._postamble.values()))):
-            code += stmt
-        return code
+        parts.append("\\end{tikzpicture}\n")
+        parts.extend(reversed(list(self._postamble.values())))
+        return "".join(parts)
 
     def __repr__(self) -> str:
-        readable_code = f"\\begin{{tikzpicture}}{brackets(self.options)}\n"
-
-        for draw_obj in self.drawing_objects:
-            readable_code += "    " + draw_obj.code + "\n"
-
-        readable_code += "\\end{tikzpicture}\n"
-        return readable_code
+        parts = [f"\\begin{{tikzpicture}}{brackets(self.options)}\n"]
+        parts.extend(f"    {draw_obj.code}\n" for draw_obj in self.drawing_objects)
+        parts.append("\\end{tikzpicture}\n")
+        return "".join(parts)
 
     def tikzset(self, style_name: str, style_rules: TikzStyle) -> TikzStyle:
         """Create and add a TikzStyle object with name "style_name" and tikzset syntax "style_rules" """
@@ -103,15 +121,17 @@ class TikzPicture(TikzEnvironment):
             "tdplotsetmaincoords"
         ] = f"\\tdplotsetmaincoords{{{theta}}}{{{phi}}}\n"
 
+    def tex_file_contents(self) -> str:
+        """Returns the contents of a standalone TeX file containing the Tikz code."""
+        return _fill_tex_file("".join(self._tex_preamble.values()), self.code())
+
     def write_tex_file(self, tex_filepath):
-        tex_code = TEX_FILE
-        tex_file_contents = re.sub("fillme", lambda x: self.code(), tex_code)
+        tex_file_contents = self.tex_file_contents()
         # Update the TeX file
         if self.BASE_DIR is not None:
             tex_filepath = self.BASE_DIR / tex_filepath
 
-        with open(tex_filepath, "w") as f:
-            f.write(tex_file_contents)
+        _write_text(tex_filepath, tex_file_contents)
 
     def write(self, tikz_code_filepath=None):
         if tikz_code_filepath is None:
@@ -122,99 +142,262 @@ class TikzPicture(TikzEnvironment):
             base_dir = self.BASE_DIR
 
         tikz_code_filepath = base_dir / tikz_code_filepath
-        with open(tikz_code_filepath, "w") as f:
-            f.write(self.code())
+        _write_text(tikz_code_filepath, self.code())
 
     def compile(
-        self, pdf_destination: Optional[str] = None, quiet: bool = True
-    ) -> Path:
+        self,
+        pdf_destination: Optional[str] = None,
+        quiet: bool = True,
+        draft: bool = False,
+    ) -> Optional[Path]:
         """Compiles the Tikz code and returns a Path to the final PDF.
         If no file path is provided, a default value of "tex_file.pdf" will be used.
+        If use_cache is set, a previously compiled PDF of the same TeX file is reused.
 
         Parameters:
             pdf_destination (str): The file path of the compiled pdf.
             quiet (bool): Parameter to silence latexmk.
+            draft (bool): Only check that the Tikz code compiles. This runs a single
+                pdflatex pass in draftmode, which skips writing the PDF, and returns None.
+                Intended for quick "does it compile" checks, e.g. in CI.
         """
+        # Generate the TeX file once; it is used both as the cache key and as the file to compile
+        tex_file_contents = self.tex_file_contents()
+        cached_pdf = None
+        if self.use_cache and not draft:
+            cached_pdf = self._cached_pdf_path(tex_file_contents)
+            if cached_pdf.exists():
+                moved_pdf_file = self._pdf_destination(pdf_destination)
+                copyfile(cached_pdf, moved_pdf_file)
+                return moved_pdf_file.resolve()
+
+        build_dir = self.TEMP_DIR
+        if self.externalize:
+            (build_dir / "ext").mkdir(exist_ok=True)
+        tex_filepath = build_dir / "tex_file.tex"
+        _write_text(tex_filepath, tex_file_contents)
+
+        options = []
+        if self.externalize:
+            # The external library compiles each picture with a system call
+            options.append("-shell-escape")
+        if draft:
+            cmd = [
+                "pdflatex",
+                "-interaction=batchmode",
+                "-halt-on-error",
+                "-draftmode",
+                *options,
+                f"-output-directory={build_dir}",
+                tex_filepath.name,
+            ]
+            completed_process = _run(cmd, build_dir, quiet)
+            if completed_process.returncode != 0:
+                _raise_compile_error(completed_process, cmd, build_dir / "tex_file.log")
+            return None
+
+        if quiet:
+            options.append("-quiet")
+        cmd = [
+            "latexmk",
+            "-pdf",
+            *options,
+            f"-output-directory={build_dir}",
+            tex_filepath.name,
+        ]
+        completed_process = _run(cmd, build_dir, quiet)
+        if completed_process.returncode != 0:
+            _raise_compile_error(completed_process, cmd, build_dir / "tex_file.log")
+
+        # We copy the compiled PDF into the same folder containing the tikz code.
+        pdf_file = tex_filepath.with_suffix(".pdf").resolve()
+        moved_pdf_file = self._pdf_destination(pdf_destination)
+        # Copy rather than move, so latexmk finds the PDF up to date on the next compile
+        copyfile(pdf_file, moved_pdf_file)
+        if cached_pdf is not None:
+            # Caching is best effort; an unwritable or full cache must not lose the PDF
+            try:
+                self._store_in_cache(pdf_file, cached_pdf)
+            except OSError as e:
+                print(f"WARNING! Failed to cache the compiled PDF in {cached_pdf}: {e}")
+        return moved_pdf_file.resolve()
+
+    @property
+    def TEMP_DIR(self) -> Path:
+        """The build directory of this TikzPicture. It is created on first use and is kept
+        between compiles, so latexmk and TikZ can reuse their auxiliary files. It is removed
+        by close(), or when the TikzPicture is garbage collected."""
+        if self._temp_dir is None:
+            self._temp_dir = Path(tempfile.mkdtemp(prefix="tikzpy_"))
+            self._temp_dir_finalizer = weakref.finalize(
+                self, rmtree, self._temp_dir, ignore_errors=True
+            )
+        return self._temp_dir
+
+    def close(self) -> None:
+        """Removes the build directory. A later compile starts from a fresh directory."""
+        if self._temp_dir_finalizer is not None:
+            self._temp_dir_finalizer()
+        self._temp_dir = None
+        self._temp_dir_finalizer = None
+
+    @classmethod
+    def compile_all(
+        cls,
+        pictures: List["TikzPicture"],
+        pdf_destination_dir: Optional[str] = None,
+        jobs: Optional[int] = None,
+        quiet: bool = True,
+        filename_prefix: str = "tex_file-figure",
+    ) -> List[Path]:
+        """Compiles several TikzPictures in parallel and returns a list of Paths to their PDFs.
+
+        The pictures are placed in a single TeX document which uses TikZ's external library in
+        "list and make" mode. A first latexmk pass writes a makefile with one target per picture,
+        which is then run with `make -j jobs` so that the pictures compile on separate cores.
+        Each PDF is cropped to its picture and is saved in pdf_destination_dir (by default, the
+        current working directory) as "<filename_prefix><i>.pdf", where i is the index of the
+        picture. Existing files with these names are overwritten, and files left over from an
+        earlier call with more pictures are not removed; pass a distinct filename_prefix or
+        pdf_destination_dir to keep the outputs of separate calls apart.
+
+        Parameters:
+            pictures (list): The TikzPictures to compile.
+            pdf_destination_dir (str): The directory to save the compiled pdfs in.
+            jobs (int): The number of pictures to compile at once. Defaults to the number of CPUs.
+            quiet (bool): Parameter to silence latexmk.
+            filename_prefix (str): The prefix of the file names of the compiled pdfs.
+        """
+        if pdf_destination_dir is None:
+            pdf_destination_dir = Path.cwd()
+        pdf_destination_dir = Path(pdf_destination_dir)
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        if jobs < 1:
+            raise ValueError(f"The number of jobs {jobs} must be at least 1.")
+        if len(pictures) == 0:
+            return []
+
         with tempfile.TemporaryDirectory() as tmp_dir:
             tex_filepath = Path(tmp_dir) / "tex_file.tex"
-            self.write_tex_file(tex_filepath)
+            tex_file_contents = _fill_tex_file(
+                "\\usetikzlibrary{external}\n\\tikzexternalize[mode=list and make]\n",
+                "\n".join(picture.code() for picture in pictures),
+            )
+            _write_text(tex_filepath, tex_file_contents)
 
-            tex_file_posix_path = true_posix_path(tex_filepath)
-            tex_file_parents = true_posix_path(tex_filepath.parent)
-            options = ""
+            # The first pass only lists the pictures and writes tex_file.makefile
+            cmd = ["latexmk", "-pdf", f"-output-directory={tmp_dir}", tex_filepath.name]
             if quiet:
-                options += " -quiet "
-            cmd = (
-                f"latexmk -pdf {options} -output-directory={tex_file_parents} {tex_file_posix_path}",
-            )
-            completed_process = subprocess.run(cmd, shell=True, capture_output=True)
+                cmd.insert(2, "-quiet")
+            completed_process = _run(cmd, tmp_dir, quiet)
+            if completed_process.returncode != 0:
+                _raise_compile_error(
+                    completed_process, cmd, Path(tmp_dir) / "tex_file.log"
+                )
+
+            cmd = ["make", "-j", str(jobs), "-f", "tex_file.makefile"]
+            completed_process = _run(cmd, tmp_dir, quiet)
+            figure_pdfs = [
+                Path(tmp_dir) / f"tex_file-figure{ind}.pdf"
+                for ind in range(len(pictures))
+            ]
             if completed_process.returncode != 0:
-                logfile = Path(tmp_dir) / "tex_file.log"
-                if not logfile.exists():
-                    raise CompileError(
-                        f"Unexpected compilation error when running {cmd=}. No log file found. Manually compile the tikz code to debug."
-                        f"{completed_process.stderr=}"
-                    )
-                # If there's a log file, try to extract the error from it
-                # and return it to the user.
-                error_content = extract_error_content(
-                    logfile.read_text().splitlines(keepends=True)
+                # Report the error of the first picture that failed to compile
+                failed_pdf = next(
+                    (pdf for pdf in figure_pdfs if not pdf.exists()), figure_pdfs[0]
+                )
+                _raise_compile_error(
+                    completed_process, cmd, failed_pdf.with_suffix(".log")
+                )
+
+            moved_pdf_files = []
+            for ind, figure_pdf in enumerate(figure_pdfs):
+                moved_pdf_file = pdf_destination_dir / f"{filename_prefix}{ind}.pdf"
+                copyfile(figure_pdf, moved_pdf_file)
+                moved_pdf_files.append(moved_pdf_file.resolve())
+            return moved_pdf_files
+
+    def _pdf_destination(self, pdf_destination: Optional[str]) -> Path:
+        """Returns where compile() should place the compiled PDF."""
+        if pdf_destination is not None:
+            return Path(pdf_destination)
+        if self.BASE_DIR is None:
+            return Path.cwd() / "tex_file.pdf"
+        return self.BASE_DIR / "tex_file.pdf"
+
+    def _cached_pdf_path(self, tex_file_contents: str) -> Path:
+        """Returns the cache location of the PDF compiled from tex_file_contents."""
+        key = hashlib.sha256(tex_file_contents.encode()).hexdigest()
+        cache_dir = self.CACHE_DIR
+        if cache_dir is None:
+            cache_dir = Path.home() / ".tikzpy_cache"
+        return Path(cache_dir) / f"{key}.pdf"
+
+    @staticmethod
+    def _store_in_cache(pdf_file: Path, cached_pdf: Path) -> None:
+        """Copies pdf_file into the cache. The copy is written to a temporary file first and
+        renamed into place so that concurrent readers never see a partially written PDF.
+        """
+        cached_pdf.parent.mkdir(parents=True, exist_ok=True)
+        # A unique temporary file per call, so concurrent stores never share a path
+        fd, tmp_name = tempfile.mkstemp(
+            prefix=f"{cached_pdf.stem}.", suffix=".tmp", dir=cached_pdf.parent
+        )
+        os.close(fd)
+        tmp_pdf = Path(tmp_name)
+        try:
+            copyfile(pdf_file, tmp_pdf)
+            tmp_pdf.replace(cached_pdf)
+        except BaseException:
+            tmp_pdf.unlink(missing_ok=True)
+            raise
+
+    def save_png(self, pdf_fp, png_destination, dpi: int = 200):
+        # Imported here since they are only needed for rasterizing, and importing them
+        # would otherwise slow down importing tikzpy.
+        import numpy as np
+        import pymupdf
+
+        # Only the last page is ever loaded and rendered; the document is closed
+        # as soon as the png is written.
+        with pymupdf.open(str(pdf_fp)) as doc:
+            # Create the png of the pdf
+            total = doc.page_count
+            if total > 1:
+                print(
+                    f"WARNING! {pdf_fp=} has more than two pages, expected only one. Going to use"
+                    " the last page. "
                 )
-                if error_content is None:
-                    raise CompileError(
-                        f"Unexpected compilation error when running {cmd=}. Failed to parse log file. Manually compile the tikz code and check the .log file."
-                        f"{completed_process.stderr=}"
-                    )
-                raise CompileError(error_content)
-
-            # We move the compiled PDF into the same folder containing the tikz code.
-            pdf_file = tex_filepath.with_suffix(".pdf").resolve()
-            if pdf_destination is None:
-                if self.BASE_DIR is None:
-                    moved_pdf_file = Path.cwd() / pdf_file.name
-                else:
-                    moved_pdf_file = self.BASE_DIR / pdf_file.name
-            else:
-                moved_pdf_file = Path(pdf_destination)
-            pdf_file.replace(moved_pdf_file)
-            return moved_pdf_file.resolve()
-
-    def save_png(self, pdf_fp, png_destination):
-        page_pngs = convert_from_path(pdf_fp)
-
-        # Create the png of the pdf
-        total = len(page_pngs)
-        ind = 0
-        if total > 1:
-            print(
-                f"WARNING! {pdf_fp=} has more than two pages, expected only one. Going to use"
-                " the last page. "
+            ind = total - 1
+            page = doc[ind]
+            print(f"Converting page {ind}/{total}")
+            # Find the boundaries on a 72 DPI grayscale thumbnail. At this resolution
+            # one pixel is one PDF point, so the boundaries are already in page coordinates.
+            thumbnail = page.get_pixmap(
+                matrix=pymupdf.Matrix(1, 1), colorspace=pymupdf.csGRAY, alpha=False
+            )
+            gray_data = np.frombuffer(thumbnail.samples, dtype=np.uint8).reshape(
+                thumbnail.height, thumbnail.width
             )
-            ind = len(page_pngs) - 1
-        page_pngs = list(page_pngs)
-        image = page_pngs[ind]
-        print(f"Converting page {ind}/{total}")
-        # easier to find boundaries of a grayscale image
-        grayscale_image = image.convert("L")
-        img_data = np.asarray(grayscale_image)
-        y_0 = find_image_start_boundary(img_data)
-        y_1 = find_image_end_boundary(img_data)
-        x_0 = find_image_start_boundary(img_data.T)
-        x_1 = find_image_end_boundary(img_data.T)
-        horizontal_len = len(img_data.T)
-        vertical_len = len(img_data.T)
-        # Zoom in the picture
-        x_0 = int(min(0.20 * horizontal_len, x_0))
-        x_1 = int(max(0.80 * horizontal_len, x_1))
-        # Add vertical whitespace padding
-        y_0 = int(max(0, y_0 - 0.02 * vertical_len))
-        y_1 = int(min(vertical_len, y_1 + 0.02 * vertical_len))
-
-        true_img = image.convert("RGB")
-        img_data = np.asarray(true_img)
-        cropped_img_data = img_data[y_0:y_1, x_0:x_1]
-        cropped_img = Image.fromarray(np.uint8(cropped_img_data))
-        cropped_img.save(str(png_destination), "PNG")
+            y_0, y_1, x_0, x_1 = find_image_boundaries(gray_data)
+            vertical_len, horizontal_len = gray_data.shape
+            # Zoom in the picture
+            x_0 = int(min(0.20 * horizontal_len, x_0))
+            x_1 = int(max(0.80 * horizontal_len, x_1))
+            # Add vertical whitespace padding
+            y_0 = int(max(0, y_0 - 0.02 * vertical_len))
+            y_1 = int(min(vertical_len, y_1 + 0.02 * vertical_len))
+
+            # Only rasterize the cropped region at the requested resolution
+            zoom = dpi / 72
+            pix = page.get_pixmap(
+                matrix=pymupdf.Matrix(zoom, zoom),
+                clip=pymupdf.Rect(x_0, y_0, x_1, y_1),
+                colorspace=pymupdf.csRGB,
+                alpha=False,
+            )
+            pix.save(str(png_destination), "png")
 
     def show(self, quiet: bool = False) -> None:
         """Compiles the Tikz code and displays the pdf to the user. Set quiet=True to shut up latexmk.
@@ -228,3 +411,59 @@ class TikzPicture(TikzEnvironment):
         scope = Scope(options=options)
         self.draw(scope)
         return scope
+
+
+def _fill_tex_file(tex_preamble: str, code: str) -> str:
+    """Returns the TEX_FILE template with tex_preamble added before \\begin{document}
+    and code filled into the document body."""
+    tex_code = TEX_FILE.replace(
+        "\\begin{document}", tex_preamble + "\\begin{document}", 1
+    )
+    return tex_code.replace("fillme", code)
+
+
+def _write_text(filepath, contents: str) -> None:
+    """Writes contents to filepath as UTF-8 with LF line endings on every platform."""
+    with open(filepath, "w", encoding="utf-8", newline="\n") as f:
+        f.write(contents)
+
+
+def _run(cmd: List[str], cwd, quiet: bool) -> subprocess.CompletedProcess:
+    """Runs cmd in cwd without a shell. stderr is captured for error reporting, and stdout
+    is discarded if quiet.
+
+    TeX runs from the build directory, so the caller's working directory is prepended to
+    TEXINPUTS to keep relative \\includegraphics, \\input and data file paths working. The
+    trailing separator keeps TeX's default search path.
+    """
+    texinputs = f"{Path.cwd()}{os.pathsep}{os.environ.get('TEXINPUTS', '')}"
+    try:
+        return subprocess.run(
+            cmd,
+            cwd=cwd,
+            env={**os.environ, "TEXINPUTS": texinputs},
+            stdout=subprocess.DEVNULL if quiet else subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        raise CompileError(
+            f"Could not run {cmd[0]!r}. Make sure it is installed and on your PATH."
+        )
+
+
+def _raise_compile_error(completed_process, cmd, logfile: Path) -> None:
+    """Raises a CompileError for a failed TeX run, using the error in logfile if possible."""
+    if not logfile.exists():
+        raise CompileError(
+            f"Unexpected compilation error when running {cmd=}. No log file found. Manually compile the tikz code to debug."
+            f"{completed_process.stderr=}"
+        )
+    # If there's a log file, try to extract the error from it
+    # and return it to the user.
+    error_content = extract_error_content(logfile.read_text().splitlines(keepends=True))
+    if error_content is None:
+        raise CompileError(
+            f"Unexpected compilation error when running {cmd=}. Failed to parse log file. Manually compile the tikz code and check the .log file."
+            f"{completed_process.stderr=}"
+        )
+    raise CompileError(error_content)
@@ -46,34 +46,54 @@ def replace_code(
     )
 
 
-def find_image_start_boundary(img_data):
-    ind = 0
-    while ind < len(img_data):
-        row = img_data[ind]
-        found = False
-        for col in row:
-            if col < 255:
-                found = True
-                break
-        if found:
-            break
-        ind += 1
-    return ind
-
-
-def find_image_end_boundary(img_data):
-    ind = len(img_data) - 1
-    while ind > 0:
-        row = img_data[ind]
-        found = False
-        for col in row:
-            if col < 255:
-                found = True
-                break
-        if found:
-            break
-        ind -= 1
-    return ind
+# Grayscale pixels below this value are considered part of the drawing, not the background.
+BACKGROUND_THRESHOLD = 255
+
+
+def _foreground_mask(img_data, axis: int, threshold: int):
+    """Returns a boolean mask along `axis` of a grayscale image, marking the rows (axis=0)
+    or columns (axis=1) that contain at least one pixel darker than `threshold`."""
+    return (img_data < threshold).any(axis=1 - axis)
+
+
+def find_image_start_boundary(
+    img_data, axis: int = 0, threshold: int = BACKGROUND_THRESHOLD
+) -> int:
+    """Returns the index of the first row (axis=0) or column (axis=1) of a grayscale image
+    containing a non-background pixel. Returns 0 if the image is blank."""
+    mask = _foreground_mask(img_data, axis, threshold)
+    return int(mask.argmax()) if mask.any() else 0
+
+
+def find_image_end_boundary(
+    img_data, axis: int = 0, threshold: int = BACKGROUND_THRESHOLD
+) -> int:
+    """Returns one past the index of the last row (axis=0) or column (axis=1) of a grayscale
+    image containing a non-background pixel, so that it can be used as a slice end.
+    Returns the length of the image along `axis` if the image is blank."""
+    mask = _foreground_mask(img_data, axis, threshold)
+    return len(mask) - int(mask[::-1].argmax())
+
+
+def find_image_boundaries(
+    img_data, threshold: int = BACKGROUND_THRESHOLD
+) -> Tuple[int, int, int, int]:
+    """Returns the boundaries (y_0, y_1, x_0, x_1) of the non-background content of a grayscale
+    image, with y_1 and x_1 exclusive.
+
+    The darkest pixel of each row is found with a single contiguous min() reduction, which
+    avoids materializing a thresholded copy of the image. Columns are then only reduced over
+    the rows which contain content.
+    """
+    row_mask = img_data.min(axis=1) < threshold
+    if not row_mask.any():
+        return 0, img_data.shape[0], 0, img_data.shape[1]
+    y_0 = int(row_mask.argmax())
+    y_1 = len(row_mask) - int(row_mask[::-1].argmax())
+    col_mask = img_data[y_0:y_1].min(axis=0) < threshold
+    x_0 = int(col_mask.argmax())
+    x_1 = len(col_mask) - int(col_mask[::-1].argmax())
+    return y_0, y_1, x_0, x_1
 
 
 def extract_error_content(log_lines: list[str]) -> str:
@@ -1,5 +1,13 @@
+import numpy as np
 import pytest
-from tikzpy.utils.helpers import brackets, replace_code, extract_error_content
+from tikzpy.utils.helpers import (
+    brackets,
+    replace_code,
+    extract_error_content,
+    find_image_start_boundary,
+    find_image_end_boundary,
+    find_image_boundaries,
+)
 
 
 @pytest.fixture
@@ -74,3 +82,35 @@ def test_extract_error_content_no_error_lines(mock_latex_error_msg):
     mock_latex_error_msg = mock_latex_error_msg.replace("!", "")
     lines = mock_latex_error_msg.splitlines(keepends=True)
     assert extract_error_content(lines) is None
+
+
+def test_find_image_boundaries():
+    img_data = np.full((6, 8), 255, dtype=np.uint8)
+    img_data[2, 3] = 0
+    img_data[4, 5] = 120
+    assert find_image_start_boundary(img_data) == 2
+    assert find_image_end_boundary(img_data) == 5
+    assert find_image_start_boundary(img_data, axis=1) == 3
+    assert find_image_end_boundary(img_data, axis=1) == 6
+    assert find_image_boundaries(img_data) == (2, 5, 3, 6)
+    cropped = img_data[2:5, 3:6]
+    assert (cropped < 255).sum() == (img_data < 255).sum()
+
+
+def test_find_image_boundaries_blank_image():
+    img_data = np.full((6, 8), 255, dtype=np.uint8)
+    assert find_image_start_boundary(img_data) == 0
+    assert find_image_end_boundary(img_data) == 6
+    assert find_image_start_boundary(img_data, axis=1) == 0
+    assert find_image_end_boundary(img_data, axis=1) == 8
+    assert find_image_boundaries(img_data) == (0, 6, 0, 8)
+
+
+def test_find_image_boundaries_threshold():
+    img_data = np.full((6, 8), 255, dtype=np.uint8)
+    img_data[1, 1] = 252  # faint anti-aliasing speck
+    img_data[3, 4] = 0
+    assert find_image_boundaries(img_data) == (1, 4, 1, 5)
+    assert find_image_boundaries(img_data, threshold=250) == (3, 4, 4, 5)
+    assert find_image_start_boundary(img_data, threshold=250) == 3
+    assert find_image_end_boundary(img_data, axis=1, threshold=250) == 5
@@ -1,4 +1,7 @@
+import os
 import tempfile
+import threading
+import pymupdf
 import pytest
 import tikzpy
 
@@ -12,6 +15,21 @@ def completed_process_factory(returncode=0):
     return Mock(returncode=returncode)
 
 
+def patch_subprocess_run(mocker, outputs):
+    """Patches subprocess.run with a fake that always succeeds. For each program that is run,
+    the files listed under its name in `outputs` are written to the working directory.
+    """
+
+    def fake_run(cmd, **kwargs):
+        for filename in outputs.get(cmd[0], []):
+            Path(kwargs["cwd"], filename).write_bytes(b"%PDF")
+        return completed_process_factory(0)
+
+    return mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.subprocess.run", side_effect=fake_run
+    )
+
+
 def test_tikz_picture_write_tex_file():
     filename = "foobar.tex"
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -93,3 +111,278 @@ def test_compile_compile_error_log_file_parsing(mocker):
             in e.value.message
         )
         assert spy.spy_return.returncode != 0
+
+
+def test_compile_cache_hit_skips_latexmk(mocker):
+    mock_run = mocker.patch("tikzpy.tikz_environments.tikz_picture.subprocess.run")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir_path = Path(tmp_dir)
+        tikz = TikzPicture(use_cache=True)
+        tikz.CACHE_DIR = tmp_dir_path / "cache"
+        tikz.circle((0, 0), 3, options="thin, fill=orange!15")
+
+        cached_pdf = tikz._cached_pdf_path(tikz.tex_file_contents())
+        cached_pdf.parent.mkdir()
+        cached_pdf.write_bytes(b"%PDF-cached")
+
+        pdf_dest = tmp_dir_path / "pdf_file.pdf"
+        assert pdf_dest.resolve() == tikz.compile(pdf_dest)
+        assert pdf_dest.read_bytes() == b"%PDF-cached"
+        mock_run.assert_not_called()
+
+        # Changing the drawing changes the cache key
+        tikz.circle((1, 1), 2)
+        assert tikz._cached_pdf_path(tikz.tex_file_contents()) != cached_pdf
+
+
+def test_compile_draft(mocker):
+    mock_run = mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.subprocess.run",
+        return_value=completed_process_factory(0),
+    )
+    tikz = TikzPicture()
+    tikz.circle((0, 0), 3, options="thin, fill=orange!15")
+    assert tikz.compile(draft=True) is None
+    cmd = mock_run.call_args.args[0]
+    assert cmd[0] == "pdflatex"
+    assert "-draftmode" in cmd
+
+
+def test_externalize_preamble():
+    tikz = TikzPicture(externalize=True)
+    tikz.circle((0, 0), 3)
+    tex_file_contents = tikz.tex_file_contents()
+    preamble, body = tex_file_contents.split("\\begin{document}")
+    assert "\\usetikzlibrary{external}" in preamble
+    assert "\\tikzexternalize[prefix=ext/]" in preamble
+    assert "tikzexternalize" not in tikz.code()
+
+
+def test_compile_all(mocker):
+    mock_run = patch_subprocess_run(
+        mocker, {"make": ["tex_file-figure0.pdf", "tex_file-figure1.pdf"]}
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tikz_a = TikzPicture()
+        tikz_a.circle((0, 0), 3)
+        tikz_b = TikzPicture()
+        tikz_b.line((0, 0), (1, 1))
+        pdf_files = TikzPicture.compile_all([tikz_a, tikz_b], tmp_dir, jobs=4)
+
+        assert pdf_files == [
+            Path(tmp_dir, "tex_file-figure0.pdf").resolve(),
+            Path(tmp_dir, "tex_file-figure1.pdf").resolve(),
+        ]
+        assert all(pdf_file.exists() for pdf_file in pdf_files)
+        assert mock_run.call_args.args[0] == [
+            "make",
+            "-j",
+            "4",
+            "-f",
+            "tex_file.makefile",
+        ]
+
+
+def test_compile_generates_code_once(mocker):
+    mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.subprocess.run",
+        return_value=completed_process_factory(0),
+    )
+    tikz = TikzPicture()
+    tikz.circle((0, 0), 3)
+    code_spy = mocker.spy(tikz, "code")
+    tikz.compile(draft=True)
+    assert code_spy.call_count == 1
+
+
+def test_temp_dir_lifecycle():
+    tikz = TikzPicture()
+    temp_dir = tikz.TEMP_DIR
+    assert temp_dir.is_dir()
+    assert tikz.TEMP_DIR == temp_dir
+
+    tikz.close()
+    assert not temp_dir.exists()
+    # A new build directory is created on demand after closing
+    new_temp_dir = tikz.TEMP_DIR
+    assert new_temp_dir.is_dir()
+
+    del tikz
+    assert not new_temp_dir.exists()
+
+
+def test_compile_externalize(mocker):
+    mock_run = patch_subprocess_run(mocker, {"latexmk": ["tex_file.pdf"]})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_dest = Path(tmp_dir) / "pdf_file.pdf"
+        tikz = TikzPicture(externalize=True)
+        tikz.circle((0, 0), 3)
+        tikz.compile(pdf_dest)
+        # latexmk's own pdflatex run renders the externalized picture; no extra pass
+        (cmd,) = [call.args[0] for call in mock_run.call_args_list]
+        assert cmd[0] == "latexmk"
+        assert "-shell-escape" in cmd
+        tikz.close()
+
+
+def test_store_in_cache_is_atomic():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir_path = Path(tmp_dir)
+        cached_pdf = tmp_dir_path / "cache" / "key.pdf"
+        pdf_files = []
+        for ind in range(8):
+            pdf_file = tmp_dir_path / f"pdf_file{ind}.pdf"
+            pdf_file.write_bytes(b"%PDF" * 1000)
+            pdf_files.append(pdf_file)
+
+        errors = []
+
+        def store(pdf_file):
+            try:
+                TikzPicture._store_in_cache(pdf_file, cached_pdf)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=store, args=(f,)) for f in pdf_files]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert cached_pdf.read_bytes() == b"%PDF" * 1000
+        # No temporary files are left behind
+        assert list(cached_pdf.parent.iterdir()) == [cached_pdf]
+
+
+def test_store_in_cache_cleans_up_on_failure(mocker):
+    mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.copyfile",
+        side_effect=OSError("disk full"),
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cached_pdf = Path(tmp_dir) / "cache" / "key.pdf"
+        with pytest.raises(OSError):
+            TikzPicture._store_in_cache(Path(tmp_dir) / "pdf_file.pdf", cached_pdf)
+        assert list(cached_pdf.parent.iterdir()) == []
+
+
+def test_cache_dir_defaults_to_home(mocker):
+    mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.Path.home",
+        return_value=Path("/fake/home"),
+    )
+    tikz = TikzPicture(use_cache=True)
+    assert TikzPicture.CACHE_DIR is None
+    cached_pdf = tikz._cached_pdf_path(tikz.tex_file_contents())
+    assert cached_pdf.parent == Path("/fake/home/.tikzpy_cache")
+
+
+def test_compile_all_no_pictures(mocker):
+    mock_run = mocker.patch("tikzpy.tikz_environments.tikz_picture.subprocess.run")
+    assert TikzPicture.compile_all([]) == []
+    mock_run.assert_not_called()
+
+
+def test_compile_all_invalid_jobs():
+    with pytest.raises(ValueError):
+        TikzPicture.compile_all([TikzPicture()], jobs=0)
+
+
+def test_compile_all_unknown_cpu_count(mocker):
+    mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.os.cpu_count", return_value=None
+    )
+
+    mock_run = patch_subprocess_run(mocker, {"make": ["tex_file-figure0.pdf"]})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        TikzPicture.compile_all([TikzPicture()], tmp_dir)
+    assert mock_run.call_args.args[0] == ["make", "-j", "1", "-f", "tex_file.makefile"]
+
+
+def make_pdf(pdf_fp, rects):
+    """Writes a PDF with one A4 page per entry of rects. Each entry is either None, for a
+    blank page, or a (rect, color) pair which is drawn filled on that page."""
+    doc = pymupdf.open()
+    for rect in rects:
+        page = doc.new_page(width=595, height=842)
+        if rect is not None:
+            rect, color = rect
+            page.draw_rect(pymupdf.Rect(*rect), color=None, fill=color)
+    doc.save(str(pdf_fp))
+    doc.close()
+
+
+def test_save_png_uses_last_page_and_crops():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_fp = Path(tmp_dir) / "pdf_file.pdf"
+        png_fp = Path(tmp_dir) / "png_file.png"
+        make_pdf(
+            pdf_fp,
+            [((300, 50, 400, 150), (0, 0, 1)), ((100, 300, 200, 400), (1, 0, 0))],
+        )
+        TikzPicture().save_png(pdf_fp, png_fp, dpi=144)
+
+        # In page coordinates the crop is x: [min(0.2 * 595, 100), max(0.8 * 595, 200)]
+        # and y: [300 - 0.02 * 842, 400 + 0.02 * 842], truncated to whole points.
+        # At 144 DPI every point is two pixels.
+        png = pymupdf.Pixmap(str(png_fp))
+        assert (png.width, png.height) == (2 * (476 - 100), 2 * (416 - 283))
+        # The red square of the last page is in the crop, starting at its left edge
+        assert png.pixel(50, 2 * (350 - 283)) == (255, 0, 0)
+
+
+def test_save_png_blank_page():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_fp = Path(tmp_dir) / "pdf_file.pdf"
+        png_fp = Path(tmp_dir) / "png_file.png"
+        make_pdf(pdf_fp, [None])
+        TikzPicture().save_png(pdf_fp, png_fp, dpi=72)
+        png = pymupdf.Pixmap(str(png_fp))
+        assert (png.width, png.height) == (595, 842)
+
+
+def test_compile_keeps_caller_dir_on_texinputs(mocker, monkeypatch):
+    mock_run = mocker.patch(
+        "tikzpy.tikz_environments.tikz_picture.subprocess.run",
+        return_value=completed_process_factory(0),
+    )
+    monkeypatch.delenv("TEXINPUTS", raising=False)
+    tikz = TikzPicture()
+    tikz.circle((0, 0), 3)
+    tikz.compile(draft=True)
+
+    kwargs = mock_run.call_args.kwargs
+    assert kwargs["cwd"] == tikz.TEMP_DIR
+    assert kwargs["env"]["TEXINPUTS"] == f"{Path.cwd()}{os.pathsep}"
+
+    monkeypatch.setenv("TEXINPUTS", "/my/styles")
+    tikz.compile(draft=True)
+    texinputs = mock_run.call_args.kwargs["env"]["TEXINPUTS"]
+    assert texinputs == f"{Path.cwd()}{os.pathsep}/my/styles"
+    tikz.close()
+
+
+def test_compile_cache_store_failure_still_returns_pdf(mocker):
+    patch_subprocess_run(mocker, {"latexmk": ["tex_file.pdf"]})
+    mocker.patch.object(
+        TikzPicture, "_store_in_cache", side_effect=OSError("read-only file system")
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_dest = Path(tmp_dir) / "pdf_file.pdf"
+        tikz = TikzPicture(use_cache=True)
+        tikz.CACHE_DIR = Path(tmp_dir) / "cache"
+        tikz.circle((0, 0), 3)
+        assert tikz.compile(pdf_dest) == pdf_dest.resolve()
+        assert pdf_dest.read_bytes() == b"%PDF"
+        tikz.close()
+
+
+def test_compile_all_filename_prefix(mocker):
+    patch_subprocess_run(mocker, {"make": ["tex_file-figure0.pdf"]})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_files = TikzPicture.compile_all(
+            [TikzPicture()], tmp_dir, filename_prefix="circles-"
+        )
+        assert pdf_files == [Path(tmp_dir, "circles-0.pdf").resolve()]
+        assert pdf_files[0].exists()